@@ -0,0 +1,584 @@
+import os
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+import swisseph as swe
+from datetime import date, timezone, timedelta
+import numpy as np
+from collections import defaultdict
+from itertools import islice, zip_longest
+import transit_table
+import progressions
+import event_scan
+import chart_cache
+import metrics
+
+# --- 初期設定 ---
+# 計算ロジックは UI から切り離し、Streamlit を読み込まずにワーカープロセスやバッチからも使えるようにする
+# 判定ロジックを変えてキャッシュ済みの結果を無効にしたいときに上げる
+CACHE_VERSION = 1
+EPHE_PATH = transit_table.EPHE_PATH
+swe.set_ephe_path(EPHE_PATH)
+
+# --- 定数定義 ---
+PLANET_IDS = {
+    "太陽": swe.SUN, "月": swe.MOON, "水星": swe.MERCURY, "金星": swe.VENUS, "火星": swe.MARS,
+    "木星": swe.JUPITER, "土星": swe.SATURN, "天王星": swe.URANUS, "海王星": swe.NEPTUNE, "冥王星": swe.PLUTO,
+}
+MAJOR_ASPECTS = { 0: '合', 60: 'セクスタイル', 90: 'スクエア', 120: 'トライン', 180: 'オポジション' }
+GOOD_ASPECTS = { 0: '合', 60: 'セクスタイル', 120: 'トライン' }
+ORB = 1.2
+HOUSE_SYSTEM = b'P'
+# イベントを計算・キャッシュする区間の長さ（出生からの経過日数）
+SEGMENT_DAYS = 365.25
+# 相手の一括ランキングで一度にまとめて走査する人数。距離行列の大きさ（メモリ）はこれで頭打ちになる
+RANKING_CHUNK = 64
+# 出生時刻が不明なときに1日を掃引する間隔（分）
+SWEEP_STEP_MINUTES = 10
+# 粗いスキャンのステップ（日）。天体の速さに合わせ、1ステップの移動量がオーブより十分小さくなるようにする
+SCAN_STEPS = {"T": {"木星": 1, "土星": 2, "天王星": 4}, "P": {"太陽": 60, "月": 10, "金星": 60}}
+DEFAULT_SCAN_STEP = {"T": 1, "P": 10}
+ZODIAC_SIGNS = ["牡羊座", "牡牛座", "双子座", "蟹座", "獅子座", "乙女座", "天秤座", "蠍座", "射手座", "山羊座", "水瓶座", "魚座"]
+RULER_OF_SIGN = {
+    "牡羊座": "火星", "牡牛座": "金星", "双子座": "水星", "蟹座": "月", "獅子座": "太陽", "乙女座": "水星",
+    "天秤座": "金星", "蠍座": "火星", "射手座": "木星", "山羊座": "土星", "水瓶座": "土星", "魚座": "木星"
+}
+EVENT_DEFINITIONS = {
+    # --- スコア 90以上 (最重要イベント) ---
+    "SA_7Ruler_CONJ_ASC_DSC": {"score": 95, "title": "SA 7H支配星がN ASC/DSCに合", "desc": "結婚の運命を司る星が「自分」か「パートナー」の感受点に重なる、極めて重要な時期。"},
+    "SA_SUN_VENUS_CONJ": {"score": 92, "title": "SA 太陽/金星が合", "desc": "人生の目的（太陽）と愛と喜び（金星）が重なる、恋愛や結婚において最も幸福な時期の一つです。運命的な出会いやプロポーズの可能性。"},
+    "P_NEW_MOON": {"score": 90, "title": "プログレス新月", "desc": "P太陽とP月が重なる、約30年に一度の人生の新しいサイクルの始まり。結婚、出産、転職など、人生の大きな節目となる重要な時期です。"},
+    "P_MOON_CONJ_SMMidpoint": {"score": 90, "title": "P月がN太陽/月ミッドポイントに合", "desc": "感情（P月）が、公私の統合を象徴する感受点に到達。結婚など、人生の重要なパートナーシップが具体化する時です。"},
+    "T_JUP_7H_INGRESS": {"score": 90, "title": "T木星が第7ハウス入り", "desc": "約12年に一度の結婚幸運期。出会いのチャンスが拡大し、関係がスムーズに進展しやすい1年間。"},
+    "T_SAT_7H_INGRESS": {"score": 90, "title": "T土星が第7ハウス入り", "desc": "パートナーシップに対する責任感が生まれ、関係を真剣に考える時期。結婚を固めるタイミング。"},
+    "T_JUP_CONJ_DSC": {"score": 90, "title": "T木星とNディセンダントが合", "desc": "素晴らしいパートナーとの出会いや、現在の関係が結婚へと発展する絶好のチャンス。"},
+    
+    # --- スコア 80台 (重要イベント) ---
+    "P_VENUS_CONJ_DSC": {"score": 88, "title": "P金星がNディセンダントに合", "desc": "あなたの愛と喜び（P金星）がパートナーシップの扉（DSC）を開く時。恋愛の成就や結婚の絶好の機会です。"},
+    "SA_VENUS_CONJ_ASC": {"score": 88, "title": "SA金星がN ASCに合", "desc": "愛される喜びを実感する時。人生の新しい扉が開き、パートナーシップが始まる。"},
+    "SA_ASC_CONJ_VENUS": {"score": 88, "title": "SA ASCがN金星に合", "desc": "自分自身が愛のエネルギーに満ち、魅力が高まる時期。恋愛や結婚の大きなチャンス。"},
+    "T_SAT_CONJ_DSC": {"score": 85, "title": "T土星とNディセンダントが合", "desc": "運命的な相手との関係が始まり、長期的な契約を結ぶ時。結婚への決意が固まる。"},
+    "SA_MC_CONJ_VENUS": {"score": 85, "title": "SA MCがN金星に合", "desc": "恋愛や結婚が社会的なステータスアップに繋がる可能性。公に認められる喜び。"},
+    "SA_JUP_CONJ_ASC": {"score": 85, "title": "SA木星がN ASCに合", "desc": "人生における大きな幸運期。拡大と発展のエネルギーが自分に降り注ぐ。"},
+    "SA_MC_CONJ_SUN": {"score": 85, "title": "SA MCがN太陽に合", "desc": "社会的頂点（MC）と人生の目的（太陽）が重なります。結婚が社会的なステータスを向上させるなど、人生の大きな節目となる時期。"},
+    "SA_VENUS_CONJ_MOON": {"score": 85, "title": "SA金星がN月に合", "desc": "愛情（金星）と感情（月）が結びつく、結婚に非常に繋がりやすい時期。プライベートな幸福感が高まります。"},
+    "T_JUP_ASPECT_VENUS": {"score": 80, "title": "T木星がN金星に吉角", "desc": "恋愛運が最高潮に。人生を楽しむ喜びにあふれ、幸せな恋愛・結婚に繋がりやすい。"},
+    "P_VENUS_ASPECT_MARS": {"score": 80, "title": "P金星がN火星にアスペクト", "desc": "愛情と情熱が結びつき、ロマンスが燃え上がる強力な配置。関係が急速に進展しやすい。"},
+    "P_MOON_7H_INGRESS": {"score": 80, "title": "P月が第7ハウス入り", "desc": "約2.5年間、結婚やパートナーへの意識が自然と高まる。心がパートナーを求める時期。"},
+    "T_JUP_CONJ_SMMidpoint": {"score": 80, "title": "T木星がN太陽/月ミッドポイントに合", "desc": "幸運の星・木星が、あなたにとって最も重要な感受点を祝福。素晴らしい出会いや関係の発展が期待できる幸運期。"},
+    "P_MOON_CONJ_DSC": {"score": 80, "title": "P月がNディセンダントに合", "desc": "あなたの感情（月）がパートナーシップの扉（DSC）を通過する約1ヶ月間。結婚や同棲を具体的に意識し、行動に移しやすい時期です。"},
+
+    # --- スコア 70台 (補助的なイベント) ---
+    "T_JUP_ASPECT_SUN": {"score": 75, "title": "T木星がN太陽に吉角", "desc": "人生の発展期。自己肯定感が高まり、良きパートナーを引き寄せ、人生のステージが上がる。"},
+    "T_URA_ASPECT_VENUS": {"score": 75, "title": "T天王星がN金星にアスペクト", "desc": "突然の出会いや電撃的な恋愛、または現在の関係に大きな変化が訪れる時期。関係が良くも悪くも大きく動く可能性があり、別離を経て新しい出会いに向かう場合も。"},
+    "P_MOON_CONJ_VENUS": {"score": 75, "title": "P月がN金星に合", "desc": "恋愛気分が盛り上がり、ときめきを感じやすい。デートや出会いに最適なタイミング。"},
+    "T_SAT_ASPECT_VENUS": {"score": 70, "title": "T土星がN金星にアスペクト", "desc": "恋愛関係に試練や責任が伴うが、それを乗り越えることで関係が安定し、真剣なものへと進む。結婚への覚悟を固める時期。"},
+    "P_MOON_CONJ_JUP": {"score": 70, "title": "P月がN木星に合", "desc": "精神的に満たされ、幸福感が高まる。楽観的な気持ちが良縁を引き寄せる。"},
+}
+# --- イベント判定ルール ---
+# (技法, 移動する点, 目標, アスペクト, オーブ, 判定, イベントキー)
+# 技法: "T"=トランジット, "P"=プログレス, "SA"=ソーラーアーク（移動する点はネイタルの感受点名）。
+# 目標: ネイタルの感受点名、"7H_cusp"=第7ハウスカスプ、"P:太陽" のような "技法:天体" は移動する目標。
+# 判定: "cross"=通過またはオーブ入り, "ingress"=順行でのハウス入り。新しいイベントは EVENT_DEFINITIONS とこの表に行を足すだけでよい。
+GOOD = tuple(GOOD_ASPECTS)
+MAJOR = tuple(MAJOR_ASPECTS)
+EVENT_RULES = [
+    # --- トランジット ---
+    ("T", "木星", "7H_cusp", (0,), ORB, "ingress", "T_JUP_7H_INGRESS"),
+    ("T", "土星", "7H_cusp", (0,), ORB, "ingress", "T_SAT_7H_INGRESS"),
+    ("T", "木星", "DSC_pos", (0,), ORB, "cross", "T_JUP_CONJ_DSC"),
+    ("T", "土星", "DSC_pos", (0,), ORB, "cross", "T_SAT_CONJ_DSC"),
+    ("T", "木星", "SunMoonMidpoint", (0,), ORB, "cross", "T_JUP_CONJ_SMMidpoint"),
+    ("T", "木星", "金星", GOOD, ORB, "cross", "T_JUP_ASPECT_VENUS"),
+    ("T", "木星", "太陽", GOOD, ORB, "cross", "T_JUP_ASPECT_SUN"),
+    ("T", "土星", "金星", MAJOR, ORB, "cross", "T_SAT_ASPECT_VENUS"),
+    ("T", "天王星", "金星", MAJOR, ORB, "cross", "T_URA_ASPECT_VENUS"),
+    # --- ソーラーアーク ---
+    ("SA", "ASC_pos", "金星", (0,), ORB, "cross", "SA_ASC_CONJ_VENUS"),
+    ("SA", "MC_pos", "金星", (0,), ORB, "cross", "SA_MC_CONJ_VENUS"),
+    ("SA", "金星", "ASC_pos", (0,), ORB, "cross", "SA_VENUS_CONJ_ASC"),
+    ("SA", "木星", "ASC_pos", (0,), ORB, "cross", "SA_JUP_CONJ_ASC"),
+    ("SA", "太陽", "金星", (0,), ORB, "cross", "SA_SUN_VENUS_CONJ"),
+    ("SA", "金星", "太陽", (0,), ORB, "cross", "SA_SUN_VENUS_CONJ"),
+    ("SA", "金星", "月", (0,), ORB, "cross", "SA_VENUS_CONJ_MOON"),
+    ("SA", "MC_pos", "太陽", (0,), ORB, "cross", "SA_MC_CONJ_SUN"),
+    ("SA", "7H_Ruler_pos", "ASC_pos", (0,), ORB, "cross", "SA_7Ruler_CONJ_ASC_DSC"),
+    ("SA", "7H_Ruler_pos", "DSC_pos", (0,), ORB, "cross", "SA_7Ruler_CONJ_ASC_DSC"),
+    # --- プログレス ---
+    ("P", "月", "7H_cusp", (0,), ORB, "ingress", "P_MOON_7H_INGRESS"),
+    ("P", "月", "木星", (0,), ORB, "cross", "P_MOON_CONJ_JUP"),
+    ("P", "月", "金星", (0,), ORB, "cross", "P_MOON_CONJ_VENUS"),
+    ("P", "月", "SunMoonMidpoint", (0,), ORB, "cross", "P_MOON_CONJ_SMMidpoint"),
+    ("P", "金星", "DSC_pos", (0,), ORB, "cross", "P_VENUS_CONJ_DSC"),
+    ("P", "月", "DSC_pos", (0,), ORB, "cross", "P_MOON_CONJ_DSC"),
+    ("P", "月", "P:太陽", (0,), ORB, "cross", "P_NEW_MOON"),
+    ("P", "金星", "火星", MAJOR, ORB, "cross", "P_VENUS_ASPECT_MARS"),
+]
+PREFECTURES = {
+    "北海道": (141.35, 43.06), "青森県": (140.74, 40.82), "岩手県": (141.15, 39.70), "宮城県": (140.87, 38.27),
+    "秋田県": (140.10, 39.72), "山形県": (140.36, 38.24), "福島県": (140.47, 37.75), "茨城県": (140.45, 36.34),
+    "栃木県": (139.88, 36.57), "群馬県": (139.06, 36.39), "埼玉県": (139.65, 35.86), "千葉県": (140.12, 35.60),
+    "東京都": (139.69, 35.69), "神奈川県": (139.64, 35.45), "新潟県": (139.02, 37.90), "富山県": (137.21, 36.70),
+    "石川県": (136.63, 36.59), "福井県": (136.07, 36.07), "山梨県": (138.57, 35.66), "長野県": (138.18, 36.65),
+    "岐阜県": (136.72, 35.39), "静岡県": (138.38, 34.98), "愛知県": (136.91, 35.18), "三重県": (136.51, 34.73),
+    "滋賀県": (135.87, 35.00), "京都府": (135.76, 35.02), "大阪府": (135.52, 34.69), "兵庫県": (135.18, 34.69),
+    "奈良県": (135.83, 34.69), "和歌山県": (135.17, 34.23), "鳥取県": (134.24, 35.50), "島根県": (133.05, 35.47),
+    "岡山県": (133.93, 34.66), "広島県": (132.46, 34.40), "山口県": (131.47, 34.19), "徳島県": (134.55, 34.07),
+    "香川県": (134.04, 34.34), "愛媛県": (132.77, 33.84), "高知県": (133.53, 33.56), "福岡県": (130.42, 33.61),
+    "佐賀県": (130.30, 33.26), "長崎県": (129.88, 32.75), "熊本県": (130.74, 32.79), "大分県": (131.61, 33.24),
+    "宮崎県": (131.42, 31.91), "鹿児島県": (130.56, 31.56), "沖縄県": (127.68, 26.21)
+}
+
+# --- 計算ロジック関数 ---
+
+def add_years(dt, years):
+    try: return dt.replace(year=dt.year + years)
+    except ValueError: return dt.replace(year=dt.year + years, month=3, day=1)
+
+def calculate_midpoint(p1, p2):
+    # スカラーでも NumPy 配列でもよい（配列なら要素ごとの中点）
+    diff = (np.asarray(p2) - p1 + 360) % 360
+    midpoint = np.where(diff <= 180, (p1 + diff / 2) % 360, (p2 + (360 - diff) / 2) % 360)
+    return float(midpoint) if midpoint.ndim == 0 else midpoint
+
+def natal_chart_key(birth_dt_jst, lon, lat):
+    return chart_cache.cache_key("natal", CACHE_VERSION, birth_dt_jst.astimezone(timezone.utc).isoformat(), lon, lat, HOUSE_SYSTEM.decode())
+
+def _ephemeris_longitude(jday, pid):
+    metrics.count("ephemeris_calls")
+    return float(swe.calc_ut(jday, pid)[0][0])
+
+@metrics.timed("natal_chart")
+@chart_cache.cached(natal_chart_key)
+def get_natal_chart(birth_dt_jst, lon, lat):
+    dt_utc = birth_dt_jst.astimezone(timezone.utc)
+    year, month, day, hour, minute, second = dt_utc.year, dt_utc.month, dt_utc.day, dt_utc.hour, dt_utc.minute, float(dt_utc.second)
+    jday = swe.utc_to_jd(year, month, day, hour, minute, second, 1)[1]
+    chart_data = {"jday": jday, "lon": lon, "lat": lat, "chart_key": natal_chart_key(birth_dt_jst, lon, lat)}
+    try:
+        with metrics.stage("swe.houses"): cusps, ascmc = swe.houses(jday, lat, lon, HOUSE_SYSTEM)
+    except Exception: return None
+    chart_data["ASC_pos"], chart_data["MC_pos"] = float(ascmc[0]), float(ascmc[1])
+    temp_planet_ids = PLANET_IDS.copy()
+    for name, pid in temp_planet_ids.items():
+        chart_data[name] = _ephemeris_longitude(jday, pid)
+    chart_data["SunMoonMidpoint"] = calculate_midpoint(chart_data["太陽"], chart_data["月"])
+    chart_data["DSC_pos"] = (chart_data["ASC_pos"] + 180) % 360
+    chart_data["IC_pos"] = (chart_data["MC_pos"] + 180) % 360
+    chart_data["cusps"] = cusps
+    dsc_sign_index = int(chart_data["DSC_pos"] / 30)
+    ruler_name = RULER_OF_SIGN[ZODIAC_SIGNS[dsc_sign_index]]
+    chart_data["7H_RulerName"], chart_data["7H_Ruler_pos"] = ruler_name, chart_data.get(ruler_name)
+    return chart_data
+
+def create_composite_chart(chart_a, chart_b):
+    return create_composite_charts(chart_a, [chart_b])[0]
+
+def create_composite_charts(chart_a, charts_b):
+    # chart_a と各相手のコンポジットをまとめて作る。感受点ごとに全員分の中点を (相手, 感受点) の配列で一度に計算する
+    names = [*PLANET_IDS, "ASC_pos", "MC_pos"]
+    points_b = np.array([[chart_b[name] for name in names] for chart_b in charts_b], dtype=np.float64).reshape(len(charts_b), len(names))
+    midpoints = calculate_midpoint(np.array([chart_a[name] for name in names], dtype=np.float64), points_b)
+    composite_charts = []
+    for chart_b, row in zip(charts_b, midpoints.tolist()):
+        composite_chart = {"lon": chart_a["lon"], "lat": chart_a["lat"], "chart_key": chart_cache.cache_key("composite", chart_a["chart_key"], chart_b["chart_key"])}
+        composite_chart.update(zip(names, row))
+        composite_chart["cusps"] = tuple([(composite_chart["ASC_pos"] + 30 * i) % 360 for i in range(12)])
+        composite_chart["DSC_pos"] = (composite_chart["ASC_pos"] + 180) % 360
+        composite_chart["jday"] = chart_a["jday"]
+        composite_chart["7H_RulerName"], composite_chart["7H_Ruler_pos"] = None, None
+        composite_chart["SunMoonMidpoint"] = calculate_midpoint(composite_chart["太陽"], composite_chart["月"])
+        composite_charts.append(composite_chart)
+    return composite_charts
+
+def _chart_point(natal_chart, name):
+    return natal_chart["cusps"][6] if name == "7H_cusp" else natal_chart.get(name)
+
+def compile_rules(natal_chart, rules=EVENT_RULES):
+    # ルール表をチャートの目標黄経の配列に展開する。移動する系列と移動する目標の組ごとにまとめ、
+    # {(系列, 目標系列 or None): {"target": 黄経, "orb": オーブ, "ingress": ハウス入りか, "keys": イベントキー}} を返す
+    groups = {}
+    for technique, body, target, aspects, orb, kind, event_key in rules:
+        if target.startswith("P:"): target_series, target_pos = ("P", target[2:]), 0.0
+        else: target_series, target_pos = None, _chart_point(natal_chart, target)
+        if target_pos is None: continue
+        if technique == "SA":
+            # ソーラーアークは全感受点が同じアーク（P太陽 - N太陽）だけ進むので、アーク1本の系列に対する目標に直す
+            if natal_chart.get(body) is None: continue
+            series_key, target_pos = ("SA", "arc"), target_pos - natal_chart[body]
+        else: series_key = (technique, body)
+        group = groups.setdefault((series_key, target_series), {"target": [], "orb": [], "ingress": [], "keys": []})
+        for aspect in aspects:
+            group["target"].append((target_pos + aspect) % 360); group["orb"].append(orb)
+            group["ingress"].append(kind == "ingress"); group["keys"].append(event_key)
+    return {group_key: {"target": np.array(group["target"]), "orb": np.array(group["orb"]), "ingress": np.array(group["ingress"]), "keys": group["keys"]}
+            for group_key, group in groups.items()}
+
+def compile_rules_batch(natal_charts):
+    # 複数チャートのルールを系列ごとに1つの表にまとめる。keys は (チャートの添字, イベントキー)。
+    # ソーラーアークはネイタル太陽がチャートごとに違うので、P太陽の系列に対する目標（目標 - 天体 + ネイタル太陽）に直す。
+    # jday の同じチャート群（同じ依頼者のコンポジット）なら系列そのものも共有できる
+    merged = {}
+    for index, natal_chart in enumerate(natal_charts):
+        for (series_key, target_series), rules in compile_rules(natal_chart).items():
+            target = rules["target"]
+            if series_key == ("SA", "arc"): series_key, target = ("P", "太陽"), (target + natal_chart["太陽"]) % 360
+            group = merged.setdefault((series_key, target_series), {"target": [], "orb": [], "ingress": [], "keys": []})
+            group["target"].append(target); group["orb"].append(rules["orb"]); group["ingress"].append(rules["ingress"])
+            group["keys"].extend((index, event_key) for event_key in rules["keys"])
+    return {group_key: {"target": np.concatenate(group["target"]), "orb": np.concatenate(group["orb"]), "ingress": np.concatenate(group["ingress"]), "keys": group["keys"]}
+            for group_key, group in merged.items()}
+
+@metrics.timed("series")
+def _build_series(natal_chart, series_keys, start_offset, end_offset):
+    # 移動する系列ごとに (粗いグリッド, グリッド上の黄経, 正確な黄経を返す関数) を作る
+    base_jday, natal_sun_pos, series = natal_chart["jday"], natal_chart["太陽"], {}
+    if ("SA", "arc") in series_keys: series_keys = set(series_keys) | {("P", "太陽")}
+    for technique, body in sorted(k for k in series_keys if k[0] == "T"):
+        grid = event_scan.scan_grid(start_offset, end_offset, SCAN_STEPS["T"].get(body, DEFAULT_SCAN_STEP["T"]))
+        col = list(transit_table.TRANSIT_PLANETS).index(body)
+        series[(technique, body)] = (grid, transit_table.transit_positions(base_jday + grid)[:, col],
+                                     lambda x, pid=PLANET_IDS[body]: _ephemeris_longitude(base_jday + x, pid))
+    # プログレスとソーラーアークは天文暦を直接呼ばず、チェビシェフ近似から評価する
+    progressed = progressions.ProgressedPositions(base_jday)
+    for technique, body in sorted(k for k in series_keys if k[0] == "P"):
+        grid = event_scan.scan_grid(start_offset, end_offset, SCAN_STEPS["P"].get(body, DEFAULT_SCAN_STEP["P"]))
+        series[(technique, body)] = (grid, progressed.longitudes(PLANET_IDS[body], grid), lambda x, pid=PLANET_IDS[body]: progressed.longitude(pid, x))
+    if ("SA", "arc") in series_keys:
+        p_sun_grid = series[("P", "太陽")][0]
+        series[("SA", "arc")] = (p_sun_grid, progressed.solar_arc(natal_sun_pos, p_sun_grid), lambda x: float(progressed.solar_arc(natal_sun_pos, [x])[0]))
+    return series
+
+@chart_cache.cached(lambda natal_chart, segment, is_composite=False: chart_cache.cache_key("segment", CACHE_VERSION, natal_chart["chart_key"], segment, is_composite))
+def find_segment_events(natal_chart, segment, is_composite=False):
+    # 出生からの経過日数 [segment * SEGMENT_DAYS, (segment + 1) * SEGMENT_DAYS) の事象を (経過日数, キー) で返す。
+    # コンポジットは 7H 支配星を持たない（None）ので、その SA ルールは compile_rules で自動的に外れる
+    start_offset, end_offset = segment * SEGMENT_DAYS, (segment + 1) * SEGMENT_DAYS
+    compiled = compile_rules(natal_chart)
+    series = _build_series(natal_chart, {k for group_key in compiled for k in group_key if k}, start_offset, end_offset)
+    return sorted(_detect(compiled, series, start_offset, end_offset))
+
+def _detect(compiled, series, start_offset, end_offset):
+    # compile_rules 形式のルールを系列に当てはめ、(経過日数, そのルールの keys の要素) のリストを返す
+    hits = []
+    for (series_key, target_series), rules in compiled.items():
+        grid, positions, position_at = series[series_key]
+        targets = rules["target"]
+        if target_series is None:
+            dist = event_scan.signed_distance(positions[:, None], targets[None, :])
+            distance_at = lambda x, j, position_at=position_at, targets=targets: float(event_scan.signed_distance(position_at(x), targets[j]))
+        else:
+            # 移動する目標（P新月のP太陽）は目標側のグリッドから補間して比較する
+            t_grid, t_positions, target_at = series[target_series]
+            moving_target = np.interp(grid, t_grid, np.unwrap(t_positions, period=360))
+            dist = event_scan.signed_distance(positions[:, None], moving_target[:, None] + targets[None, :])
+            distance_at = lambda x, j, position_at=position_at, target_at=target_at, targets=targets: float(event_scan.signed_distance(position_at(x), target_at(x) + targets[j]))
+        for day_offset, j in event_scan.detect_crossings(grid, dist, distance_at, rules["orb"], rules["ingress"], start_offset, end_offset):
+            hits.append((float(day_offset), rules["keys"][j]))
+    return hits
+
+def _window_offsets(birth_dt, start_dt, end_dt):
+    start_offset = max((start_dt - birth_dt).total_seconds() / 86400, 0.0)
+    end_offset = (end_dt - birth_dt).total_seconds() / 86400
+    return start_offset, end_offset, range(int(start_offset // SEGMENT_DAYS), int(np.ceil(end_offset / SEGMENT_DAYS)))
+
+# --- イベントの列形式表現 ---
+# イベントは日付ごとに (日付の序数, キー集合のビットマスク, 素点, 正規化スコア) の NumPy 配列で持ち、
+# 従来の辞書のリストに戻すのは表示・出力の直前（to_dicts）だけにする
+EVENT_KEYS = tuple(EVENT_DEFINITIONS)
+# キー集合は uint64 のビットマスクなので 64 種類まで（超えるとシフトが黙って桁あふれする）
+if len(EVENT_KEYS) > 64: raise RuntimeError(f"イベントの種類が {len(EVENT_KEYS)} あり、uint64 のビットマスクに収まりません（上限 64）")
+EVENT_CODES = {key: code for code, key in enumerate(EVENT_KEYS)}
+EVENT_SCORES = np.array([EVENT_DEFINITIONS[key]["score"] for key in EVENT_KEYS], dtype=np.int64)
+COUPLE_PERSONS = ("Aさん", "Bさん", "お二人の関係性")
+_CODE_BITS = np.arange(len(EVENT_KEYS), dtype=np.uint64)
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def _mask_bits(masks):
+    # ビットマスク → (件数, キー数) の真偽値の行列
+    return ((np.asarray(masks, dtype=np.uint64)[:, None] >> _CODE_BITS) & np.uint64(1)).astype(bool)
+
+def _mask_keys(mask):
+    return [EVENT_KEYS[code] for code in np.flatnonzero(_mask_bits([mask])[0])]
+
+def score_masks(masks):
+    return _mask_bits(masks).astype(np.int64) @ EVENT_SCORES
+
+class EventTable:
+    # 日付ごとの事象。day は date.toordinal()、mask は EVENT_KEYS の添字のビット、normalized は正規化前なら None
+    __slots__ = ("day", "mask", "score", "normalized")
+
+    def __init__(self, day, mask, score, normalized=None):
+        self.day, self.mask, self.score, self.normalized = day, mask, score, normalized
+
+    @classmethod
+    def concat(cls, tables):
+        tables = list(tables)
+        normalized = None if any(table.normalized is None for table in tables) else np.concatenate([table.normalized for table in tables] or [np.empty(0)])
+        return cls(np.concatenate([table.day for table in tables] or [np.empty(0, np.int64)]), np.concatenate([table.mask for table in tables] or [np.empty(0, np.uint64)]),
+                   np.concatenate([table.score for table in tables] or [np.empty(0, np.int64)]), normalized)
+
+    def __reduce__(self):
+        # pickle と st.cache_data のハッシュは __reduce__ を使う。配列のまま渡せば配列のバイト列だけで済む
+        return EventTable, (self.day, self.mask, self.score, self.normalized)
+
+    def __len__(self):
+        return len(self.day)
+
+    def to_dicts(self, limit=None):
+        # 従来の {"date", "score", "keys", "normalized_score"} の辞書のリストにする（表示・出力用）
+        rows = []
+        for i in range(len(self) if limit is None else min(limit, len(self))):
+            row = {"date": date.fromordinal(int(self.day[i])), "score": int(self.score[i]), "keys": _mask_keys(self.mask[i])}
+            if self.normalized is not None: row["normalized_score"] = float(self.normalized[i])
+            rows.append(row)
+        return rows
+
+class CoupleTable:
+    # 月ごとの統合結果。month は 1970年1月からの月数、masks は (月, COUPLE_PERSONS) ごとのキーのビットマスク
+    __slots__ = ("month", "score", "normalized", "masks")
+
+    def __init__(self, month, score, normalized, masks):
+        self.month, self.score, self.normalized, self.masks = month, score, normalized, masks
+
+    def __reduce__(self):
+        return CoupleTable, (self.month, self.score, self.normalized, self.masks)
+
+    def __len__(self):
+        return len(self.month)
+
+    def to_dicts(self, limit=None):
+        # 従来の {"month": "YYYY-MM", "score", "normalized_score", "events_detail": {人: キー}} の辞書のリストにする
+        rows = []
+        for i in range(len(self) if limit is None else min(limit, len(self))):
+            month = int(self.month[i])
+            rows.append({"month": f"{1970 + month // 12}-{month % 12 + 1:02d}", "score": float(self.score[i]), "normalized_score": float(self.normalized[i]),
+                         "events_detail": {person: _mask_keys(mask) for person, mask in zip(COUPLE_PERSONS, self.masks[i]) if mask}})
+        return rows
+
+def _day_index(birth_dt, day_offsets):
+    # 出生からの経過日数 → birth_dt のタイムゾーンでの日付の序数
+    since_midnight = (birth_dt - birth_dt.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds() / 86400
+    return np.floor(since_midnight + np.asarray(day_offsets, dtype=np.float64)).astype(np.int64) + birth_dt.toordinal()
+
+@metrics.timed("scoring")
+def group_events(days, codes):
+    # 事象（日付の序数, キーの添字）を日付ごとにまとめ、キーの集合をビットマスクにして日付順の EventTable を返す
+    days, inverse = np.unique(days, return_inverse=True)
+    masks = np.zeros(len(days), dtype=np.uint64)
+    np.bitwise_or.at(masks, inverse, np.left_shift(np.uint64(1), np.asarray(codes, dtype=np.uint64)))
+    return EventTable(days, masks, score_masks(masks))
+
+@metrics.timed("scoring")
+def normalize_events(events):
+    # 最大スコアを100%とした正規化スコアを付け、スコアの高い順（同点は日付順）に並べ替えた EventTable を返す。
+    # 走査の途中で呼べばその時点までの暫定値、全事象に対して呼べば find_events と同じ最終結果になる
+    max_score = events.score.max() if len(events) else 0
+    normalized = (events.score / max_score) * 100 if max_score > 0 else np.zeros(len(events))
+    order = np.argsort(-events.score, kind="stable")
+    return EventTable(events.day[order], events.mask[order], events.score[order], normalized[order])
+
+def _stream_events(segment_hits, birth_dt, start_offset, end_offset):
+    # segment_hits: (年区間, その区間の (経過日数, キー)) の並び → (確定した日付の上限, その区間の EventTable) を時系列順に返す。
+    # 区間の境目は日の途中にあるので、境目の日の事象は次の区間と合わせてから返す
+    carry_days, carry_codes = np.empty(0, np.int64), np.empty(0, np.int64)
+    end_day = int(_day_index(birth_dt, end_offset))
+    for segment, hits in segment_hits:
+        offsets = np.array([day_offset for day_offset, _ in hits], dtype=np.float64)
+        codes = np.array([EVENT_CODES[event_key] for _, event_key in hits], dtype=np.int64)
+        in_window = (offsets >= start_offset) & (offsets < end_offset)
+        days, codes = np.concatenate([carry_days, _day_index(birth_dt, offsets[in_window])]), np.concatenate([carry_codes, codes[in_window]])
+        boundary = min(int(_day_index(birth_dt, (segment + 1) * SEGMENT_DAYS)), end_day)
+        ready = days < boundary
+        carry_days, carry_codes = days[~ready], codes[~ready]
+        yield date.fromordinal(boundary), group_events(days[ready], codes[ready])
+    if len(carry_days): yield date.fromordinal(end_day), group_events(carry_days, carry_codes)
+
+def iter_events(natal_chart, birth_dt, start_dt, end_dt, is_composite=False):
+    # find_events の逐次版。年区間を1つ計算するたびに (この日付より前は確定, 新しく確定した事象の EventTable) を返す。
+    # 正規化スコアはまだ無い（最大値は全期間を見るまで決まらない）ので、表示側で normalize_events を使う
+    start_offset, end_offset, segments = _window_offsets(birth_dt, start_dt, end_dt)
+    yield from _stream_events(((segment, find_segment_events(natal_chart, segment, is_composite)) for segment in segments), birth_dt, start_offset, end_offset)
+
+def find_events(natal_chart, birth_dt, start_dt, end_dt, is_composite=False):
+    # [start_dt, end_dt) の期間だけを、年単位の区間キャッシュを再利用しながら計算する
+    return normalize_events(EventTable.concat(chunk for _, chunk in iter_events(natal_chart, birth_dt, start_dt, end_dt, is_composite)))
+
+# --- 並列実行 ---
+
+def init_worker(ephe_path=EPHE_PATH):
+    swe.set_ephe_path(ephe_path)
+
+def create_process_pool(max_workers=None):
+    # fork はサーバーのスレッドや SQLite 接続を引き継いでしまうため spawn で起動する
+    return ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), mp_context=multiprocessing.get_context("spawn"), initializer=init_worker)
+
+def _resolve(parts):
+    for segment, part in parts:
+        if isinstance(part, Future):
+            with metrics.stage("pool_wait"): part = part.result()
+        yield segment, part
+
+def iter_events_parallel(jobs, executor=None):
+    # jobs: [(natal_chart, birth_dt, start_dt, end_dt, is_composite), ...]。各ジョブの iter_events を年区間ごとに揃えて
+    # (全ジョブで確定した日付の上限, ジョブごとの新しい事象のタプル) を返す。
+    # 全ジョブの未計算の年区間を最初にまとめてプールに投入するので、タイムライン間・タイムライン内の両方で並列になる
+    if executor is None:
+        streams = [iter_events(*job) for job in jobs]
+    else:
+        streams = []
+        for natal_chart, birth_dt, start_dt, end_dt, is_composite in jobs:
+            start_offset, end_offset, segments = _window_offsets(birth_dt, start_dt, end_dt)
+            parts = []
+            for segment in segments:
+                hits = find_segment_events.peek(natal_chart, segment, is_composite)
+                parts.append((segment, hits if hits is not None else executor.submit(find_segment_events, natal_chart, segment, is_composite)))
+            streams.append(_stream_events(_resolve(parts), birth_dt, start_offset, end_offset))
+    for steps in zip_longest(*streams, fillvalue=(None, EventTable.concat([]))):
+        yield min(through for through, _ in steps if through is not None), tuple(chunk for _, chunk in steps)
+
+def find_events_parallel(jobs, executor=None):
+    # 各ジョブの find_events と同じ結果を順に返す
+    timelines = [[] for _ in jobs]
+    for _, chunks in iter_events_parallel(jobs, executor):
+        for chunk_list, chunk in zip(timelines, chunks): chunk_list.append(chunk)
+    return [normalize_events(EventTable.concat(chunk_list)) for chunk_list in timelines]
+
+@metrics.timed("synthesis")
+def synthesize_couple_events(events_a, events_b, events_comp):
+    # 3本の正規化済みタイムラインを月ごとに合算する。月は 1970年1月からの月数の整数にして np.unique でまとめる
+    timelines = (events_a, events_b, events_comp)
+    months = np.concatenate([(timeline.day - _EPOCH_ORDINAL).astype("datetime64[D]").astype("datetime64[M]").astype(np.int64) for timeline in timelines])
+    months, inverse = np.unique(months, return_inverse=True)
+    scores = np.zeros(len(months))
+    np.add.at(scores, inverse, np.concatenate([timeline.normalized for timeline in timelines]))
+    masks, start = np.zeros((len(months), len(timelines)), dtype=np.uint64), 0
+    for person, timeline in enumerate(timelines):
+        np.bitwise_or.at(masks[:, person], inverse[start:start + len(timeline)], timeline.mask); start += len(timeline)
+    max_combined_score = scores.max() if len(scores) else 0
+    keep = scores > 0
+    normalized = (scores / max_combined_score) * 100 if max_combined_score > 0 else np.zeros(len(scores))
+    order = np.argsort(-scores[keep], kind="stable")
+    return CoupleTable(months[keep][order], scores[keep][order], normalized[keep][order], masks[keep][order])
+
+# --- 相手の一括ランキング ---
+
+def find_composite_events_batch(composite_charts, birth_dt, start_dt, end_dt):
+    # 同じ依頼者のコンポジット群（jday が共通）を、共有の系列と全員分の目標をつないだ1つの距離行列でまとめて走査する。
+    # 各チャートの find_events(..., is_composite=True) と同じ結果をチャートの順に返す
+    start_offset, end_offset, segments = _window_offsets(birth_dt, start_dt, end_dt)
+    compiled = compile_rules_batch(composite_charts)
+    series_keys = {k for group_key in compiled for k in group_key if k}
+    segment_hits = [[] for _ in composite_charts]
+    for segment in segments:
+        segment_start, segment_end = segment * SEGMENT_DAYS, (segment + 1) * SEGMENT_DAYS
+        series = _build_series(composite_charts[0], series_keys, segment_start, segment_end)
+        hits_by_chart = [[] for _ in composite_charts]
+        for day_offset, (index, event_key) in _detect(compiled, series, segment_start, segment_end):
+            hits_by_chart[index].append((day_offset, event_key))
+        for hits, new_hits in zip(segment_hits, hits_by_chart): hits.append((segment, sorted(new_hits)))
+    return [normalize_events(EventTable.concat(chunk for _, chunk in _stream_events(hits, birth_dt, start_offset, end_offset))) for hits in segment_hits]
+
+def rank_partners(client_chart, client_birth_dt, candidates, start_dt, end_dt, top=3, chunk_size=RANKING_CHUNK, executor=None):
+    # candidates: (id, natal_chart, birth_dt) の並び（イテレーターでよい）。依頼者のタイムラインは一度だけ計算し、相手は chunk_size 人ずつ
+    # コンポジットをまとめて作って一括で走査する。[start_dt, end_dt) での統合スコアの最大の月が高い順に
+    # {"id", "peak_score", "peak_month", "top_months"} を返す（normalized_score は組ごとの相対値なので順位には素の score を使う）
+    events_a, ranking, candidates = find_events(client_chart, client_birth_dt, start_dt, end_dt), [], iter(candidates)
+    while chunk := list(islice(candidates, chunk_size)):
+        ids, charts, births = zip(*chunk)
+        composite_charts = create_composite_charts(client_chart, charts)
+        if executor is None: events_comp = find_composite_events_batch(composite_charts, client_birth_dt, start_dt, end_dt)
+        else: events_comp = executor.submit(find_composite_events_batch, composite_charts, client_birth_dt, start_dt, end_dt)
+        events_b = find_events_parallel([(chart, birth_dt, start_dt, end_dt, False) for chart, birth_dt in zip(charts, births)], executor)
+        if isinstance(events_comp, Future):
+            with metrics.stage("pool_wait"): events_comp = events_comp.result()
+        for candidate_id, events, events_c in zip(ids, events_b, events_comp):
+            couple_events = synthesize_couple_events(events_a, events, events_c)
+            top_months = couple_events.to_dicts(max(top, 1))
+            ranking.append({"id": candidate_id, "peak_score": top_months[0]["score"] if top_months else 0.0,
+                            "peak_month": top_months[0]["month"] if top_months else None, "top_months": top_months[:top]})
+    return sorted(ranking, key=lambda x: x["peak_score"], reverse=True)
+
+# --- 出生時刻の掃引 ---
+# 出生時刻が不明なとき、出生日の 0:00 から SWEEP_STEP_MINUTES 分おきの全時刻で鑑定し、どのピークが時刻によらず現れるかを調べる。
+# 時刻をずらしても変わるのはネイタルの感受点（特に ASC/MC・ハウス・月）と進行の起点だけなので、
+#   - 時間軸は出生日 0:00 からの経過日数に揃え、トランジットの系列は全時刻で1本を共有する
+#   - プログレスとソーラーアークは大域的なチェビシェフ近似から、時刻ごとの起点のずれを足して配列で評価する
+#   - 全時刻の目標を1つの距離行列に並べて一度に走査し、根の精密化も全区間をまとめて配列で行う
+#   - 系列がその年区間で動く範囲（＋オーブ）から外れた目標は通過もオーブ入りもしないので、距離行列に入れない
+# トランジットは天文暦ではなく日ごとの表の3次補間で評価する。時刻は通常の鑑定と秒単位でしか違わないが、
+# 留の近くでオーブの縁をかすめるだけの事象は、粗いグリッドの取り方の違いで日付が1〜2日前後することがある
+
+def _sweep_longitudes(series_key, birth_jdays, ref_jday, x, chart_index):
+    # 出生日 0:00 からの経過日数 x における、チャート chart_index の系列の黄経（x と chart_index はブロードキャストされる）
+    technique, body = series_key
+    if technique == "T":
+        # 全時刻で共通なので chart_index によらず x の形のまま返す
+        x = np.asarray(x, dtype=np.float64)
+        return transit_table.transit_positions(ref_jday + x.ravel(), cubic=True)[:, list(transit_table.TRANSIT_PLANETS).index(body)].reshape(x.shape)
+    birth_jday = birth_jdays[chart_index]
+    return progressions.longitudes(PLANET_IDS[body], birth_jday + (x - (birth_jday - ref_jday)) / 365.25)
+
+def _sweep_hits(charts, ref_dt, start_dt, end_dt):
+    # 全時刻のチャートの事象を (日付の序数, チャートの添字, キーの添字) の配列で返す
+    birth_jdays, ref_jday = np.array([chart["jday"] for chart in charts]), charts[0]["jday"]
+    start_offset, end_offset, segments = _window_offsets(ref_dt, start_dt, end_dt)
+    groups = [(series_key, target_series, rules["target"], rules["orb"], rules["ingress"],
+               np.array([index for index, _ in rules["keys"]]), np.array([EVENT_CODES[event_key] for _, event_key in rules["keys"]]))
+              for (series_key, target_series), rules in compile_rules_batch(charts).items()]
+    found = []
+    for segment in segments:
+        segment_start, segment_end = segment * SEGMENT_DAYS, (segment + 1) * SEGMENT_DAYS
+        for series_key, target_series, targets, orb, ingress, chart_index, codes in groups:
+            grid = event_scan.scan_grid(segment_start, segment_end, SCAN_STEPS[series_key[0]].get(series_key[1], DEFAULT_SCAN_STEP[series_key[0]]))
+            if len(grid) < 2: continue
+
+            def distance_at(x, j, series_key=series_key, target_series=target_series, chart_index=chart_index, targets=targets):
+                target = targets[j] if target_series is None else _sweep_longitudes(target_series, birth_jdays, ref_jday, x, chart_index[j]) + targets[j]
+                return event_scan.signed_distance(_sweep_longitudes(series_key, birth_jdays, ref_jday, x, chart_index[j]), target)
+
+            with metrics.stage("crossing_scan"):
+                if target_series is None:
+                    track = np.unwrap(_sweep_longitudes(series_key, birth_jdays, ref_jday, grid[:, None], chart_index[None, :]), axis=0, period=360)
+                    lo, span = track.min(axis=0), np.ptp(track, axis=0)
+                    near = np.flatnonzero((targets - lo + orb) % 360 <= span + 2 * orb)
+                else: near = np.arange(len(targets))
+                dist = distance_at(grid[:, None], near[None, :])
+                (cross_i, cross_j), (enter_i, enter_j) = event_scan.find_brackets(dist, orb[near], ingress[near])
+                cross_j, enter_j = near[cross_j], near[enter_j]
+            owned_cross, owned_enter = grid[cross_i] >= segment_start, grid[enter_i] >= segment_start
+            cross_i, cross_j, enter_i, enter_j = cross_i[owned_cross], cross_j[owned_cross], enter_i[owned_enter], enter_j[owned_enter]
+            with metrics.stage("refinement"):
+                roots = np.concatenate([
+                    event_scan.refine_roots(lambda sel, x: distance_at(x, cross_j[sel]), grid[cross_i], grid[cross_i + 1]),
+                    event_scan.refine_roots(lambda sel, x: np.abs(distance_at(x, enter_j[sel])) - orb[enter_j[sel]], grid[enter_i], grid[enter_i + 1]),
+                ])
+            j = np.concatenate([cross_j, enter_j])
+            in_window = (roots >= start_offset) & (roots < end_offset)
+            found.append((_day_index(ref_dt, roots[in_window]), chart_index[j[in_window]], codes[j[in_window]]))
+    if not found: return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int64)
+    return tuple(np.concatenate(column) for column in zip(*found))
+
+@metrics.timed("sweep")
+def sweep_birth_times(birth_day_dt, lon, lat, start_dt, end_dt, step_minutes=SWEEP_STEP_MINUTES, top=15):
+    # birth_day_dt: 出生日の 0:00（タイムゾーン付き）。各時刻の鑑定で TOP{top} に入った日を月にまとめ、
+    # その月がピークに入った時刻の割合 confidence (%) の高い順に
+    # {"month", "confidence", "support" (ピークになった時刻の数), "total" (調べた時刻の数), "times", "mean_score", "keys"} のリストを返す
+    births = [birth_day_dt + timedelta(minutes=minute) for minute in range(0, 1440, step_minutes)]
+    charts = [(birth_dt, chart) for birth_dt in births if (chart := get_natal_chart(birth_dt, lon, lat))]
+    if not charts: return []
+    days, chart_index, codes = _sweep_hits([chart for _, chart in charts], births[0], start_dt, end_dt)
+    # 時刻ごとに通常の鑑定と同じく日付でまとめて正規化し、上位の日を月にする
+    support = defaultdict(lambda: {"times": [], "scores": [], "mask": 0})
+    for index, (birth_dt, _) in enumerate(charts):
+        mine = chart_index == index
+        events = normalize_events(group_events(days[mine], codes[mine]))
+        months = (events.day[:top] - _EPOCH_ORDINAL).astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+        for month in np.unique(months):
+            peak = months == month
+            entry = support[int(month)]
+            entry["times"].append(birth_dt.strftime("%H:%M")); entry["scores"].append(float(events.normalized[:top][peak].max()))
+            entry["mask"] |= int(np.bitwise_or.reduce(events.mask[:top][peak]))
+    results = [{"month": f"{1970 + month // 12}-{month % 12 + 1:02d}", "confidence": len(entry["times"]) / len(charts) * 100, "support": len(entry["times"]),
+                "total": len(charts), "times": entry["times"], "mean_score": float(np.mean(entry["scores"])), "keys": _mask_keys(entry["mask"])}
+               for month, entry in support.items()]
+    return sorted(results, key=lambda x: (x["confidence"], x["mean_score"]), reverse=True)
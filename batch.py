@@ -0,0 +1,275 @@
+"""結婚タイミング鑑定のバッチ実行。
+
+CSV / Parquet の出生データを読み、プロセスプールで並列に鑑定して、終わった順に JSONL / Parquet へ書き出す。
+
+    python batch.py customers.csv readings.jsonl --workers 8
+    python batch.py customers.parquet readings.parquet --start-year 2026 --end-year 2036
+
+入力の列: id (必須), birth_date (YYYY-MM-DD), birth_time (HH:MM, 省略時 12:00), pref (都道府県名) または lon, lat。
+partner_birth_date, partner_birth_time, partner_pref / partner_lon, partner_lat があれば2人用の鑑定になる。
+start_age, end_age (1人用) / start_year, end_year (2人用) の列があればコマンドラインの指定より優先する。
+出力に既に成功 (status が ok) として書かれた id は飛ばすので、中断しても同じコマンドで再開でき、失敗した行はその際に再試行される。
+再試行の結果は追記されるため同じ id の行が複数残ることがある。読むときは id ごとに最後の行を採用する（成功後に再試行されることはない）。
+
+--client-birth-date を指定するとランキングモードになり、入力の各行を候補の相手として依頼者1人と組み合わせ、
+鑑定期間の統合スコアのピークが高い順に並べて書き出す（依頼者のタイムラインは一度だけ計算する）。
+
+    python batch.py candidates.csv ranking.jsonl --client-birth-date 1982-10-06 --client-birth-time 02:30 --client-pref 東京都
+"""
+import os
+import sys
+import json
+import math
+import time
+import glob
+import argparse
+import datetime
+from datetime import timezone, timedelta
+from concurrent.futures import FIRST_COMPLETED, wait
+import astro
+
+JST = timezone(timedelta(hours=9))
+READ_CHUNK_ROWS = 1000
+PARQUET_PART_ROWS = 1000
+TAIL_CHUNK_BYTES = 64 * 1024
+
+# --- 入力 ---
+
+def iter_records(path):
+    # 入力全体をメモリに載せないよう、チャンク単位で1行ずつ返す
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=READ_CHUNK_ROWS):
+            yield from batch.to_pylist()
+    else:
+        import pandas as pd
+        for chunk in pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=READ_CHUNK_ROWS):
+            yield from chunk.to_dict("records")
+
+def _value(record, key):
+    value = record.get(key)
+    if value is None or (isinstance(value, float) and math.isnan(value)) or str(value).strip() == "": return None
+    return str(value).strip()
+
+def _birth(record, prefix=""):
+    if (birth_date := _value(record, f"{prefix}birth_date")) is None: return None
+    hour, minute = map(int, (_value(record, f"{prefix}birth_time") or "12:00").split(":")[:2])
+    birth_dt = datetime.datetime(*map(int, birth_date[:10].split("-")), hour, minute, tzinfo=JST)
+    if (pref := _value(record, f"{prefix}pref")) is not None: lon, lat = astro.PREFECTURES[pref]
+    else: lon, lat = float(_value(record, f"{prefix}lon")), float(_value(record, f"{prefix}lat"))
+    return birth_dt, lon, lat
+
+# --- 鑑定 ---
+
+def read_record(record, options):
+    started = time.perf_counter()
+    result = {"id": _value(record, "id")}
+    try:
+        if result["id"] is None: raise ValueError("id がありません")
+        birth, partner = _birth(record), _birth(record, "partner_")
+        if birth is None: raise ValueError("birth_date がありません")
+        chart = astro.get_natal_chart(*birth)
+        if chart is None: raise ValueError("チャートの作成に失敗しました")
+        if partner is None:
+            start_age = int(_value(record, "start_age") or options["start_age"])
+            end_age = int(_value(record, "end_age") or options["end_age"])
+            birth_day = birth[0].replace(hour=0, minute=0)  # 年齢は日付で数えるので期間は誕生日の0時で区切る
+            events = astro.find_events(chart, birth[0], astro.add_years(birth_day, start_age), astro.add_years(birth_day, end_age + 1))
+            birth_date = birth[0].date()
+            result["mode"], result["events"] = "single", [{
+                "date": event["date"].isoformat(), "score": event["score"], "normalized_score": event["normalized_score"], "keys": sorted(event["keys"]),
+                "age": event["date"].year - birth_date.year - ((event["date"].month, event["date"].day) < (birth_date.month, birth_date.day)),
+            } for event in events.to_dicts(options["top"])]
+        else:
+            chart_b = astro.get_natal_chart(*partner)
+            if chart_b is None: raise ValueError("パートナーのチャートの作成に失敗しました")
+            start_year = int(_value(record, "start_year") or options["start_year"])
+            end_year = int(_value(record, "end_year") or options["end_year"])
+            start_dt, end_dt = datetime.datetime(start_year, 1, 1, tzinfo=JST), datetime.datetime(end_year + 1, 1, 1, tzinfo=JST)
+            events_a, events_b, events_comp = astro.find_events_parallel([
+                (chart, birth[0], start_dt, end_dt, False),
+                (chart_b, partner[0], start_dt, end_dt, False),
+                (astro.create_composite_chart(chart, chart_b), birth[0], start_dt, end_dt, True),
+            ])
+            result["mode"], result["events"] = "couple", _couple_months(astro.synthesize_couple_events(events_a, events_b, events_comp).to_dicts(options["top"]))
+        result["status"] = "ok"
+    except Exception as e:
+        result["status"], result["error"] = "error", f"{type(e).__name__}: {e}"
+    result["elapsed_sec"] = round(time.perf_counter() - started, 4)
+    return result
+
+def _couple_months(couple_events):
+    return [{
+        "month": event["month"], "score": event["score"], "normalized_score": event["normalized_score"],
+        "events_detail": {person: sorted(set(keys)) for person, keys in event["events_detail"].items()},
+    } for event in couple_events]
+
+# --- 出力 ---
+
+class JsonlWriter:
+    def __init__(self, path):
+        self.path = path
+        # 中断で最後の行が途中までしか書かれていなければ、その行を捨ててから追記する
+        # 既存の出力は大きくなりうるので、全体は読まずに末尾から改行を探す
+        if os.path.exists(path):
+            with open(path, "rb+") as f:
+                end = f.seek(0, os.SEEK_END)
+                if end and (f.seek(end - 1), f.read(1))[1] != b"\n":
+                    pos = end
+                    while pos > 0:
+                        step = min(TAIL_CHUNK_BYTES, pos)
+                        f.seek(pos - step); chunk = f.read(step); pos -= step
+                        if (newline := chunk.rfind(b"\n")) >= 0:
+                            pos += newline + 1; break
+                    f.truncate(pos)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def done_ids(self):
+        # 失敗した行は再試行させるため、成功した id だけを返す
+        ids = set()
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                if row.get("status") == "ok" and row.get("id") is not None: ids.add(row["id"])
+        return ids
+
+    def write(self, result):
+        self.file.write(json.dumps(result, ensure_ascii=False) + "\n"); self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ParquetWriter:
+    # Parquet は追記できないため、出力先をディレクトリとし PARQUET_PART_ROWS 件ごとに part ファイルを書く
+    def __init__(self, path):
+        self.path, self.rows = path, []
+        os.makedirs(path, exist_ok=True)
+        self.part = len(glob.glob(os.path.join(path, "part-*.parquet")))
+
+    def done_ids(self):
+        import pyarrow.parquet as pq
+        ids = set()
+        for part in glob.glob(os.path.join(self.path, "part-*.parquet")):
+            table = pq.read_table(part, columns=["id", "status"])
+            ids.update(i for i, status in zip(table.column("id").to_pylist(), table.column("status").to_pylist()) if status == "ok" and i is not None)
+        return ids
+
+    def write(self, result):
+        self.rows.append({**{k: result.get(k) for k in ("id", "status", "mode", "error", "elapsed_sec")}, "events": json.dumps(result.get("events", []), ensure_ascii=False)})
+        if len(self.rows) >= PARQUET_PART_ROWS: self._flush()
+
+    def _flush(self):
+        if not self.rows: return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([("id", pa.string()), ("status", pa.string()), ("mode", pa.string()), ("error", pa.string()), ("elapsed_sec", pa.float64()), ("events", pa.string())])
+        tmp_path = os.path.join(self.path, f".part-{self.part:05d}.tmp")
+        pq.write_table(pa.Table.from_pylist(self.rows, schema=schema), tmp_path)
+        os.replace(tmp_path, os.path.join(self.path, f"part-{self.part:05d}.parquet"))
+        self.part, self.rows = self.part + 1, []
+
+    def close(self):
+        self._flush()
+
+# --- 実行 ---
+
+def run(input_path, output_path, options, workers=None, max_pending=None, report_every=10.0):
+    writer = ParquetWriter(output_path) if output_path.endswith(".parquet") else JsonlWriter(output_path)
+    done = writer.done_ids()
+    workers = workers or os.cpu_count()
+    max_pending = max_pending or workers * 4
+    counts, started, last_report = {"ok": 0, "error": 0, "skipped": 0}, time.perf_counter(), time.perf_counter()
+
+    def report(final=False):
+        elapsed = time.perf_counter() - started
+        processed = counts["ok"] + counts["error"]
+        print(f"{'完了' if final else '進行中'}: {processed}件 (成功 {counts['ok']} / 失敗 {counts['error']} / 既存 {counts['skipped']}) "
+              f"{elapsed:.1f}秒, {processed / elapsed if elapsed > 0 else 0:.2f}件/秒", file=sys.stderr)
+
+    with astro.create_process_pool(workers) as executor:
+        pending = set()
+        try:
+            for record in iter_records(input_path):
+                if _value(record, "id") in done:
+                    counts["skipped"] += 1; continue
+                # 投入済みの件数を max_pending に抑え、入力の大きさによらずメモリを一定に保つ
+                while len(pending) >= max_pending:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        result = future.result(); writer.write(result); counts[result["status"]] += 1
+                pending.add(executor.submit(read_record, record, options))
+                if time.perf_counter() - last_report >= report_every:
+                    report(); last_report = time.perf_counter()
+            for future in pending:
+                result = future.result(); writer.write(result); counts[result["status"]] += 1
+        finally:
+            writer.close()
+    report(final=True)
+    return counts
+
+def rank(input_path, output_path, client, options, workers=None, chunk_size=astro.RANKING_CHUNK):
+    # ランキングは全候補を見終わるまで順位が決まらないので、再開はせず最後にまとめて書き出す
+    client_chart = astro.get_natal_chart(*client)
+    if client_chart is None: raise ValueError("依頼者のチャートの作成に失敗しました")
+    start_dt, end_dt = datetime.datetime(options["start_year"], 1, 1, tzinfo=JST), datetime.datetime(options["end_year"] + 1, 1, 1, tzinfo=JST)
+    errors, started = [], time.perf_counter()
+
+    def candidates():
+        for record in iter_records(input_path):
+            try:
+                if _value(record, "id") is None: raise ValueError("id がありません")
+                if (birth := _birth(record)) is None: raise ValueError("birth_date がありません")
+                if (chart := astro.get_natal_chart(*birth)) is None: raise ValueError("チャートの作成に失敗しました")
+                yield _value(record, "id"), chart, birth[0]
+            except Exception as e:
+                errors.append({"id": _value(record, "id"), "status": "error", "error": f"{type(e).__name__}: {e}"})
+
+    with astro.create_process_pool(workers) as executor:
+        ranking = astro.rank_partners(client_chart, client[0], candidates(), start_dt, end_dt, options["top"], chunk_size, executor)
+    rows = [{"rank": rank, "id": entry["id"], "status": "ok", "peak_score": entry["peak_score"], "peak_month": entry["peak_month"],
+             "months": _couple_months(entry["top_months"])} for rank, entry in enumerate(ranking, 1)] + errors
+    if output_path.endswith(".parquet"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([("rank", pa.int64()), ("id", pa.string()), ("status", pa.string()), ("error", pa.string()),
+                            ("peak_score", pa.float64()), ("peak_month", pa.string()), ("months", pa.string())])
+        pq.write_table(pa.Table.from_pylist([{**row, "months": json.dumps(row.get("months", []), ensure_ascii=False)} for row in rows], schema=schema), output_path)
+    else:
+        with open(output_path, "w", encoding="utf-8") as f:
+            for row in rows: f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    elapsed = time.perf_counter() - started
+    print(f"完了: 候補 {len(ranking)}件 (失敗 {len(errors)}) {elapsed:.1f}秒, {len(ranking) / elapsed if elapsed > 0 else 0:.2f}件/秒", file=sys.stderr)
+    return {"ok": len(ranking), "error": len(errors)}
+
+def main(argv=None):
+    this_year = datetime.date.today().year
+    parser = argparse.ArgumentParser(description="出生データの CSV / Parquet から結婚タイミングをまとめて鑑定する")
+    parser.add_argument("input", help="入力ファイル (.csv / .parquet)")
+    parser.add_argument("output", help="出力先 (.jsonl、または part ファイルを置くディレクトリ .parquet)")
+    parser.add_argument("--workers", type=int, default=None, help="ワーカープロセス数 (既定: CPU数)")
+    parser.add_argument("--max-pending", type=int, default=None, help="同時に投入しておく件数の上限 (既定: ワーカー数×4)")
+    parser.add_argument("--start-age", type=int, default=20)
+    parser.add_argument("--end-age", type=int, default=40)
+    parser.add_argument("--start-year", type=int, default=this_year)
+    parser.add_argument("--end-year", type=int, default=this_year + 10)
+    parser.add_argument("--top", type=int, default=None, help="1件あたりに出力する上位イベント数 (既定: 15、ランキングでは月数 3)")
+    parser.add_argument("--client-birth-date", default=None, help="ランキングモードの依頼者の生年月日 (YYYY-MM-DD)")
+    parser.add_argument("--client-birth-time", default="12:00")
+    parser.add_argument("--client-pref", default=None, help="依頼者の出生地 (都道府県名)。--client-lon / --client-lat でも可")
+    parser.add_argument("--client-lon", type=float, default=None)
+    parser.add_argument("--client-lat", type=float, default=None)
+    parser.add_argument("--chunk-size", type=int, default=astro.RANKING_CHUNK, help="ランキングで一度にまとめて走査する候補数")
+    args = parser.parse_args(argv)
+    options = {"start_age": args.start_age, "end_age": args.end_age, "start_year": args.start_year, "end_year": args.end_year,
+               "top": args.top or (3 if args.client_birth_date else 15)}
+    if args.client_birth_date:
+        client = _birth({"birth_date": args.client_birth_date, "birth_time": args.client_birth_time, "pref": args.client_pref, "lon": args.client_lon, "lat": args.client_lat})
+        counts = rank(args.input, args.output, client, options, args.workers, args.chunk_size)
+        return 1 if counts["error"] else 0
+    counts = run(args.input, args.output, options, args.workers, args.max_pending)
+    return 1 if counts["error"] else 0
+
+if __name__ == "__main__":
+    try: sys.exit(main())
+    except KeyboardInterrupt:
+        print("中断しました。同じコマンドで再開できます。", file=sys.stderr); sys.exit(130)
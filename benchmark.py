@@ -0,0 +1,219 @@
+"""チャート・イベント・統合処理のベンチマーク。
+
+同梱の ephe/*.se1 だけを使いオフラインで動く。キャッシュは毎回空の一時ディレクトリを使う。
+
+    python benchmark.py run                      # 計測して benchmarks/baseline.json に保存
+    python benchmark.py compare                  # 計測して baseline と比較し、閾値を超える悪化があれば終了コード 1
+    python benchmark.py golden                   # イベントの日付とスコアが benchmarks/golden.json と一致するか確認
+    python benchmark.py golden --update          # 意図してロジックを変えたときに golden を更新する
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import platform
+import tempfile
+import tracemalloc
+from datetime import timezone, timedelta
+import numpy as np
+import swisseph as swe
+import astro
+import chart_cache
+import progressions
+import transit_table
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+GOLDEN_PATH = os.path.join(BENCH_DIR, "golden.json")
+JST = timezone(timedelta(hours=9))
+BIRTH_A = (datetime.datetime(1982, 10, 6, 2, 30, tzinfo=JST), *astro.PREFECTURES["東京都"])
+BIRTH_B = (datetime.datetime(1976, 12, 25, 16, 25, tzinfo=JST), *astro.PREFECTURES["沖縄県"])
+GOLDEN_BIRTHS = [BIRTH_A, BIRTH_B, (datetime.datetime(1995, 2, 28, 12, 0, tzinfo=JST), *astro.PREFECTURES["北海道"])]
+HORIZONS = (10, 40, 80)
+MIN_WALL_DELTA_SEC = 0.002  # これ未満の時間差は計測の揺らぎとみなす
+
+# --- 計測の仕組み ---
+
+class CallCounter:
+    # swe.calc_ut を数える。各モジュールは呼び出しのたびに swe.calc_ut を引くので、モジュール属性の差し替えで足りる
+    def __init__(self):
+        self.calls, self._original = 0, swe.calc_ut
+
+    def __enter__(self):
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return self._original(*args, **kwargs)
+        swe.calc_ut = counted
+        return self
+
+    def __exit__(self, *exc):
+        swe.calc_ut = self._original
+
+_cache_dir = None
+
+def reset_caches():
+    # 毎回まっさらなディスクキャッシュとチェビシェフ近似から始める（トランジット表は共有資源なので残す）。
+    # スキーマと WAL の作成は計測したい処理ではないので、空のキャッシュはここで作っておく
+    global _cache_dir
+    cleanup_caches()
+    _cache_dir = tempfile.TemporaryDirectory(prefix="bench-cache-")
+    chart_cache.CACHE_DIR = _cache_dir.name
+    chart_cache.get_cache()
+    progressions._block.cache_clear()
+
+def cleanup_caches():
+    # 前回の一時キャッシュは接続を閉じてからディレクトリごと消す
+    global _cache_dir
+    if chart_cache.get_cache.cache_info().currsize: chart_cache.get_cache().close()
+    chart_cache.get_cache.cache_clear()
+    if _cache_dir is not None:
+        _cache_dir.cleanup(); _cache_dir = None
+
+def measure(setup, func, repeat):
+    # setup() の戻り値を func に渡す。時間は tracemalloc なしで repeat 回の最小値（timeit と同じく揺らぎに強い）、メモリは別に1回測る
+    times, calls = [], 0
+    for _ in range(repeat):
+        arg = setup()
+        with CallCounter() as counter:
+            started = time.perf_counter(); func(arg); times.append(time.perf_counter() - started)
+        calls = counter.calls
+    arg = setup()
+    tracemalloc.start()
+    func(arg)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"wall_sec": round(min(times), 6), "calc_ut_calls": calls, "peak_mem_kb": round(peak / 1024, 1)}
+
+# --- ベンチマーク項目 ---
+
+def _window(birth_dt, years):
+    return birth_dt, astro.add_years(birth_dt, years)
+
+def _synthetic_events(count, seed):
+    rng, start = random.Random(seed), datetime.date(1950, 1, 1).toordinal()
+    days = np.array([start + rng.randrange(150 * 365) for _ in range(count)], dtype=np.int64)
+    masks = np.array([sum(1 << code for code in rng.sample(range(len(astro.EVENT_KEYS)), rng.randint(1, 3))) for _ in range(count)], dtype=np.uint64)
+    scores = astro.score_masks(masks)
+    return astro.EventTable(days, masks, scores, scores / 3)
+
+def cases():
+    def cold_charts():
+        reset_caches()
+        return astro.get_natal_chart(*BIRTH_A), astro.get_natal_chart(*BIRTH_B)
+
+    def cold_events():
+        # チャートだけ用意し、イベントの区間キャッシュとチェビシェフ近似は空にする
+        charts = cold_charts(); reset_caches()
+        return charts
+
+    def warm_natal():
+        reset_caches(); astro.get_natal_chart(*BIRTH_A)
+
+    yield "get_natal_chart/cold", reset_caches, lambda _: astro.get_natal_chart(*BIRTH_A)
+    yield "get_natal_chart/warm", warm_natal, lambda _: astro.get_natal_chart(*BIRTH_A)
+    yield "create_composite_chart", cold_charts, lambda charts: astro.create_composite_chart(*charts)
+    for years in HORIZONS:
+        yield f"find_events/single/{years}y", cold_events, lambda charts, years=years: astro.find_events(charts[0], BIRTH_A[0], *_window(BIRTH_A[0], years))
+        yield (f"find_events/composite/{years}y", cold_events,
+               lambda charts, years=years: astro.find_events(astro.create_composite_chart(*charts), BIRTH_A[0], *_window(BIRTH_A[0], years), is_composite=True))
+    birth_day = BIRTH_A[0].replace(hour=0, minute=0)
+    yield "sweep_birth_times/20y", reset_caches, lambda _: astro.sweep_birth_times(birth_day, *BIRTH_A[1:], astro.add_years(birth_day, 20), astro.add_years(birth_day, 41))
+    synthetic = [_synthetic_events(20000, seed) for seed in range(3)]
+    yield "synthesize_couple_events/60k", lambda: synthetic, lambda lists: astro.synthesize_couple_events(*lists)
+
+def run_benchmarks(repeat, only=None):
+    transit_table.load_transit_table()
+    results = {}
+    try:
+        for name, setup, func in cases():
+            if only and only not in name: continue
+            results[name] = measure(setup, func, repeat)
+            print(f"{name:40s} {results[name]['wall_sec'] * 1000:10.2f} ms {results[name]['calc_ut_calls']:8d} calls {results[name]['peak_mem_kb']:10.1f} KiB", file=sys.stderr)
+    finally:
+        cleanup_caches()
+    return {"meta": {"python": platform.python_version(), "machine": platform.machine(), "cpu_count": os.cpu_count(),
+                     "created": datetime.datetime.now().isoformat(timespec="seconds"), "repeat": repeat}, "results": results}
+
+def compare(baseline, current, threshold):
+    regressions = []
+    for name, old in baseline["results"].items():
+        if (new := current["results"].get(name)) is None: continue
+        for metric in ("wall_sec", "calc_ut_calls", "peak_mem_kb"):
+            if metric == "wall_sec" and new[metric] - old[metric] < MIN_WALL_DELTA_SEC: continue
+            if old[metric] > 0 and new[metric] > old[metric] * (1 + threshold):
+                regressions.append(f"{name}: {metric} {old[metric]} -> {new[metric]} (+{(new[metric] / old[metric] - 1) * 100:.0f}%)")
+    return regressions
+
+# --- ゴールデン出力 ---
+
+def golden_outputs():
+    reset_caches()
+    try:
+        charts = [astro.get_natal_chart(*birth) for birth in GOLDEN_BIRTHS]
+        outputs = {}
+        for i, (chart, birth) in enumerate(zip(charts, GOLDEN_BIRTHS)):
+            events = astro.find_events(chart, birth[0], *_window(birth[0], 80))
+            outputs[f"single/{i}"] = sorted([event["date"].isoformat(), event["score"], sorted(event["keys"])] for event in events.to_dicts())
+        start_dt, end_dt = datetime.datetime(2000, 1, 1, tzinfo=JST), datetime.datetime(2041, 1, 1, tzinfo=JST)
+        composite = astro.create_composite_chart(charts[0], charts[1])
+        timelines = astro.find_events_parallel([
+            (charts[0], BIRTH_A[0], start_dt, end_dt, False), (charts[1], BIRTH_B[0], start_dt, end_dt, False), (composite, BIRTH_A[0], start_dt, end_dt, True)])
+        outputs["composite"] = sorted([event["date"].isoformat(), event["score"], sorted(event["keys"])] for event in timelines[2].to_dicts())
+        outputs["couple"] = sorted([event["month"], round(event["score"], 6)] for event in astro.synthesize_couple_events(*timelines).to_dicts())
+    finally:
+        cleanup_caches()
+    return outputs
+
+def check_golden(expected, actual):
+    problems = []
+    for name in sorted(set(expected) | set(actual)):
+        old = {json.dumps(row, ensure_ascii=False) for row in expected.get(name, [])}
+        new = {json.dumps(row, ensure_ascii=False) for row in actual.get(name, [])}
+        if old != new:
+            problems.append(f"{name}: 欠落 {len(old - new)} / 追加 {len(new - old)} 例: {sorted(old ^ new)[:3]}")
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="チャート・イベント・統合処理のベンチマーク")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_parser = sub.add_parser("run", help="計測して JSON に保存する")
+    run_parser.add_argument("--output", default=BASELINE_PATH)
+    compare_parser = sub.add_parser("compare", help="計測して baseline と比較する")
+    compare_parser.add_argument("--baseline", default=BASELINE_PATH)
+    compare_parser.add_argument("--threshold", type=float, default=0.2, help="悪化とみなす増加率 (既定 0.2 = 20%%)")
+    compare_parser.add_argument("--output", default=None, help="今回の結果も保存する場合の出力先")
+    for p in (run_parser, compare_parser):
+        p.add_argument("--repeat", type=int, default=5)
+        p.add_argument("--only", default=None, help="名前にこの文字列を含む項目だけ計測する")
+    golden_parser = sub.add_parser("golden", help="イベントの日付とスコアが golden と一致するか確認する")
+    golden_parser.add_argument("--update", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.command == "golden":
+        actual = golden_outputs()
+        if args.update or not os.path.exists(GOLDEN_PATH):
+            os.makedirs(BENCH_DIR, exist_ok=True)
+            with open(GOLDEN_PATH, "w", encoding="utf-8") as f: json.dump(actual, f, ensure_ascii=False, indent=1)
+            print(f"golden を保存しました: {GOLDEN_PATH}", file=sys.stderr); return 0
+        with open(GOLDEN_PATH, encoding="utf-8") as f: expected = json.load(f)
+        problems = check_golden(expected, actual)
+        for problem in problems: print(problem, file=sys.stderr)
+        print("golden と一致しました" if not problems else "golden と一致しません", file=sys.stderr)
+        return 1 if problems else 0
+
+    current, regressions = run_benchmarks(args.repeat, args.only), []
+    if args.command == "compare":
+        with open(args.baseline, encoding="utf-8") as f: baseline = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        for regression in regressions: print(f"悪化: {regression}", file=sys.stderr)
+        print("悪化はありません" if not regressions else f"{len(regressions)}件の悪化があります", file=sys.stderr)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f: json.dump(current, f, ensure_ascii=False, indent=1)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import zlib
+import pickle
+import sqlite3
+import hashlib
+import functools
+import threading
+import metrics
+
+# --- 初期設定 ---
+# 出生データ等の入力から作ったハッシュをキーに、チャートとイベントをローカルディスク（SQLite）に保存する。
+# 再起動後や別ワーカープロセスからも共有され、容量が上限を超えたら最終アクセスが古い順に削除する（LRU）。
+CACHE_DIR = os.environ.get("MARRIAGE_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+CACHE_MAX_BYTES = int(os.environ.get("MARRIAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+def cache_key(*parts):
+    canonical = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class DiskCache:
+    def __init__(self, path, max_bytes):
+        self.path, self.max_bytes, self._local = path, max_bytes, threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+
+    def _connect(self):
+        # sqlite3 の接続はスレッド間で共有できないため、スレッドごとに持つ
+        if getattr(self._local, "conn", None) is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return self._local.conn
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None: return None
+            conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        try: return pickle.loads(zlib.decompress(row[0]))
+        except Exception:
+            # 壊れた値や、コードの変更で読めなくなった古い値は削除してキャッシュミスとして扱う
+            with conn: conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+
+    def close(self):
+        # このスレッドの接続だけを閉じる（次に使えば開き直す）
+        if (conn := getattr(self._local, "conn", None)) is not None:
+            conn.close(); self._local.conn = None
+
+    def set(self, key, value):
+        blob = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO entries (key, value, size, last_access) VALUES (?, ?, ?, ?)", (key, blob, len(blob), time.time()))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        excess = (conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]) - self.max_bytes
+        if excess <= 0: return
+        stale = []
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access"):
+            stale.append((key,)); excess -= size
+            if excess <= 0: break
+        conn.executemany("DELETE FROM entries WHERE key = ?", stale)
+
+@functools.lru_cache(maxsize=None)
+def get_cache(path=None, max_bytes=CACHE_MAX_BYTES):
+    return DiskCache(path or os.path.join(CACHE_DIR, "charts.sqlite3"), max_bytes)
+
+def _get(key):
+    try: return get_cache().get(key)
+    except (OSError, sqlite3.Error): return None
+
+def _set(key, value):
+    try: get_cache().set(key, value)
+    except (OSError, sqlite3.Error): pass
+
+def cached(key_func):
+    # key_func は元の関数と同じ引数を受け取り、cache_key() で作ったキーを返す。None の結果は保存しない。
+    # wrapper.peek(...) は計算せずにキャッシュ済みの値だけを返す（無ければ None）。ヒット/ミスは peek でも数える
+    # （2人用の区間はワーカーで計算され、メインプロセスからは peek でしか見えないため）
+    def decorator(func):
+        hit_name, miss_name = f"cache_hits.{func.__name__}", f"cache_misses.{func.__name__}"
+
+        def lookup(key):
+            value = _get(key)
+            metrics.count(hit_name if value is not None else miss_name)
+            return value
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = key_func(*args, **kwargs)
+            value = lookup(key)
+            if value is None:
+                value = func(*args, **kwargs)
+                if value is not None: _set(key, value)
+            return value
+        wrapper.peek = lambda *args, **kwargs: lookup(key_func(*args, **kwargs))
+        return wrapper
+    return decorator
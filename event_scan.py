@@ -0,0 +1,85 @@
+import numpy as np
+import metrics
+
+# --- 粗いスキャンと根の精密化 ---
+# 移動天体と感受点の角度差を天体の速さに合ったステップで標本化し、
+# 符号が変わる区間（通過）とオーブに入る区間を挟み込んでから、
+# 天文暦に対して Illinois 法（改良はさみうち法）で正確な時刻まで絞り込む。
+
+def signed_distance(pos, target):
+    return (np.asarray(pos, dtype=np.float64) - target + 180) % 360 - 180
+
+def scan_grid(start, end, step):
+    # step の整数倍に揃えたグリッドで [start, end) を覆う。区間ごとに計算しても
+    # 同じ点で標本化されるので、隣り合う区間の結果が重複も欠落もしない
+    if end <= start: return np.empty(0)
+    return step * np.arange(np.floor(start / step), np.ceil(end / step) + 1)
+
+def find_brackets(dist, orb, ingress):
+    # dist: (グリッド点数, ルール数) の角度差。orb, ingress はルールごとの配列。
+    # 通過とオーブ入りそれぞれについて (区間の添字, ルールの添字) の配列の組を返す
+    d0, d1 = dist[:-1], dist[1:]
+    # ±180度での折り返しは目標点の通過ではないので除外する。ハウス入りは順行で境界を越えた場合のみ
+    crossing = ((d0 < 0) != (d1 < 0)) & (np.abs(d1 - d0) < 180) & (~ingress | (d1 > d0))
+    entering = (np.abs(d1) <= orb) & (np.abs(d0) > orb) & ~ingress
+    return np.nonzero(crossing), np.nonzero(entering)
+
+def refine_root(func, a, b, tol=1e-3, max_iter=60):
+    fa, fb = func(a), func(b)
+    if fa == 0: return a
+    if fb == 0 or (fa < 0) == (fb < 0): return b
+    c, side = b, 0
+    for _ in range(max_iter):
+        c = (a * fb - b * fa) / (fb - fa)
+        fc = func(c)
+        if fc == 0: break
+        if (fc < 0) == (fb < 0):
+            b, fb = c, fc
+            if side == -1: fa /= 2
+            side = -1
+        else:
+            a, fa = c, fc
+            if side == 1: fb /= 2
+            side = 1
+        if b - a < tol: break
+    return c
+
+def refine_roots(func, a, b, tol=1e-3, max_iter=60):
+    # refine_root の配列版。多数の区間 [a, b] を同時に Illinois 法で絞り込む。
+    # func(sel, x) は区間の添字の配列 sel とその点 x の配列を受け取り、同じ長さの値の配列を返す
+    a, b = np.array(a, dtype=np.float64), np.array(b, dtype=np.float64)
+    everything = np.arange(len(a))
+    fa, fb = func(everything, a), func(everything, b)
+    roots = np.where(fa == 0, a, b)
+    side = np.zeros(len(a), dtype=np.int8)
+    active = (fa != 0) & (fb != 0) & ((fa < 0) != (fb < 0))
+    for _ in range(max_iter):
+        if not active.any(): break
+        sel = np.flatnonzero(active)
+        c = (a[sel] * fb[sel] - b[sel] * fa[sel]) / (fb[sel] - fa[sel])
+        fc = func(sel, c)
+        roots[sel] = c
+        same = ((fc < 0) == (fb[sel] < 0)) & (fc != 0)
+        other = ~same & (fc != 0)
+        upd, low = sel[same], sel[other]
+        fa[upd[side[upd] == -1]] /= 2
+        b[upd], fb[upd], side[upd] = c[same], fc[same], -1
+        fb[low[side[low] == 1]] /= 2
+        a[low], fa[low], side[low] = c[other], fc[other], 1
+        active[sel] = (fc != 0) & (b[sel] - a[sel] >= tol)
+    return roots
+
+def detect_crossings(grid, dist, distance_at, orb, ingress, start=-np.inf, end=np.inf, tol=1e-3):
+    # grid 上の角度差 dist（ルールごとの列）から事象を検出し、(正確な時刻, ルールの添字) のリストを返す。
+    # distance_at(x, j) はルール j の正確な角度差。左端が [start, end) にある区間だけを担当する
+    hits = []
+    with metrics.stage("crossing_scan"):
+        (cross_i, cross_j), (enter_i, enter_j) = find_brackets(dist, orb, ingress)
+    with metrics.stage("refinement"):
+        for i, j in zip(cross_i, cross_j):
+            if start <= grid[i] < end:
+                hits.append((refine_root(lambda x: distance_at(x, j), grid[i], grid[i + 1], tol), j))
+        for i, j in zip(enter_i, enter_j):
+            if start <= grid[i] < end:
+                hits.append((refine_root(lambda x: abs(distance_at(x, j)) - orb[j], grid[i], grid[i + 1], tol), j))
+    return hits
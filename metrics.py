@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import threading
+import functools
+import contextlib
+from collections import defaultdict
+
+# --- 初期設定 ---
+# 鑑定1回（リクエスト）ごとに、処理段階ごとの時間と、天文暦の呼び出し・キャッシュ命中などの回数を記録する。
+# start_request() で有効にしたスレッドだけが記録し、それ以外では stage() は共有の空コンテキスト、count() は何もしない。
+# MARRIAGE_METRICS=1 なら全リクエストで有効。MARRIAGE_METRICS_PROM / MARRIAGE_METRICS_LOG を指定すると、
+# リクエストの終わりに Prometheus 形式のテキスト（プロセスの累計）と JSON Lines のログを書き出す。
+ALWAYS_ON = os.environ.get("MARRIAGE_METRICS") == "1"
+PROM_PATH = os.environ.get("MARRIAGE_METRICS_PROM")  # "{pid}" を含めるとプロセスごとのファイルになる
+LOG_PATH = os.environ.get("MARRIAGE_METRICS_LOG")
+
+_local = threading.local()
+_lock = threading.Lock()
+_NULL = contextlib.nullcontext()
+_totals = {"requests": 0, "seconds": defaultdict(float), "calls": defaultdict(int), "counters": defaultdict(int)}
+
+class _Request:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds, self.calls, self.counters = defaultdict(float), defaultdict(int), defaultdict(int)
+
+class _Stage:
+    __slots__ = ("request", "name", "started")
+
+    def __init__(self, request, name):
+        self.request, self.name = request, name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.request.seconds[self.name] += time.perf_counter() - self.started
+        self.request.calls[self.name] += 1
+
+def start_request(enabled=False):
+    _local.request = _Request() if (enabled or ALWAYS_ON) else None
+
+def stage(name):
+    request = getattr(_local, "request", None)
+    return _NULL if request is None else _Stage(request, name)
+
+def count(name, n=1):
+    request = getattr(_local, "request", None)
+    if request is not None: request.counters[name] += n
+
+def timed(name):
+    # 関数全体を stage(name) で囲むデコレーター
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name): return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def finish_request(**info):
+    # 記録を閉じて要約を返す（無効なら None）。プロセスの累計に加え、設定されていれば書き出す
+    request, _local.request = getattr(_local, "request", None), None
+    if request is None: return None
+    summary = {"time": time.time(), **info, "total_sec": time.perf_counter() - request.started,
+               "stages": {name: {"seconds": request.seconds[name], "calls": request.calls[name]} for name in request.seconds},
+               "counters": dict(request.counters)}
+    with _lock:
+        _totals["requests"] += 1
+        for name, seconds in request.seconds.items(): _totals["seconds"][name] += seconds
+        for name, calls in request.calls.items(): _totals["calls"][name] += calls
+        for name, n in request.counters.items(): _totals["counters"][name] += n
+        if PROM_PATH: write_prometheus(PROM_PATH.format(pid=os.getpid()))
+        if LOG_PATH:
+            with open(LOG_PATH, "a", encoding="utf-8") as f: f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+    return summary
+
+def write_prometheus(path):
+    lines = ["# TYPE marriage_requests_total counter", f"marriage_requests_total {_totals['requests']}",
+             "# TYPE marriage_stage_seconds_total counter"]
+    lines += [f'marriage_stage_seconds_total{{stage="{name}"}} {seconds:.6f}' for name, seconds in sorted(_totals["seconds"].items())]
+    lines += ["# TYPE marriage_stage_calls_total counter"]
+    lines += [f'marriage_stage_calls_total{{stage="{name}"}} {calls}' for name, calls in sorted(_totals["calls"].items())]
+    lines += ["# TYPE marriage_counter_total counter"]
+    lines += [f'marriage_counter_total{{name="{name}"}} {n}' for name, n in sorted(_totals["counters"].items())]
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f: f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
@@ -0,0 +1,58 @@
+import functools
+import numpy as np
+from numpy.polynomial import chebyshev
+import swisseph as swe
+import metrics
+
+# --- 初期設定 ---
+# 二次進行法では人生の1年が天文暦の1日に当たるため、80年分の進行でも実際の暦は約80日しかない。
+# 天体の黄経を実際の暦 BLOCK_DAYS 日ごとの区分的チェビシェフ多項式で近似し、進行位置とソーラーアークを
+# 任意の日について安価に、配列でまとめて評価できるようにする。区間はユリウス日の絶対値で区切るので、
+# 出生日の近いチャート同士でも同じ近似を共有する。
+BLOCK_DAYS = 16.0
+DEGREE = 16
+TOLERANCE = 1e-5  # 度。検証点での誤差がこれを超える区間は半分に分けて近似し直す
+CHECK_POINTS = 4
+MIN_PIECE_DAYS = 1 / 64
+
+def _fit(pid, start, end):
+    metrics.count("ephemeris_calls", DEGREE + 1 + CHECK_POINTS)
+    nodes = np.cos(np.pi * (np.arange(DEGREE + 1) + 0.5) / (DEGREE + 1))
+    lons = np.unwrap([swe.calc_ut(start + (node + 1) * (end - start) / 2, pid)[0][0] for node in nodes], period=360)
+    coef = chebyshev.chebfit(nodes, lons, DEGREE)
+    # 標本点の間で天文暦と比べて誤差を検証する
+    checks = (np.arange(CHECK_POINTS) + 0.5) / CHECK_POINTS * 2 - 1
+    actual = np.array([swe.calc_ut(start + (u + 1) * (end - start) / 2, pid)[0][0] for u in checks])
+    error = np.max(np.abs((chebyshev.chebval(checks, coef) - actual + 180) % 360 - 180))
+    if error > TOLERANCE and end - start > MIN_PIECE_DAYS:
+        mid = (start + end) / 2
+        return _fit(pid, start, mid) + _fit(pid, mid, end)
+    return [(start, end, coef)]
+
+@functools.lru_cache(maxsize=4096)
+def _block(pid, index):
+    return tuple(_fit(pid, index * BLOCK_DAYS, (index + 1) * BLOCK_DAYS))
+
+def longitudes(pid, jdays):
+    jdays = np.atleast_1d(np.asarray(jdays, dtype=np.float64))
+    positions, index = np.empty_like(jdays), np.floor(jdays / BLOCK_DAYS).astype(np.int64)
+    for block_index in np.unique(index):
+        in_block = index == block_index
+        for start, end, coef in _block(pid, int(block_index)):
+            sel = in_block & (jdays >= start) & (jdays <= end)
+            positions[sel] = chebyshev.chebval(2 * (jdays[sel] - start) / (end - start) - 1, coef) % 360
+    return positions
+
+class ProgressedPositions:
+    # 1つのチャートの進行位置。出生からの経過日数 day_offset は実際の暦 base_jday + day_offset / 365.25 に当たる
+    def __init__(self, base_jday):
+        self.base_jday = base_jday
+
+    def longitudes(self, pid, day_offsets):
+        return longitudes(pid, self.base_jday + np.asarray(day_offsets, dtype=np.float64) / 365.25)
+
+    def longitude(self, pid, day_offset):
+        return float(self.longitudes(pid, [day_offset])[0])
+
+    def solar_arc(self, natal_sun_pos, day_offsets):
+        return (self.longitudes(swe.SUN, day_offsets) - natal_sun_pos) % 360
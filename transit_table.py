@@ -0,0 +1,71 @@
+import os
+import sys
+import functools
+import numpy as np
+import swisseph as swe
+import metrics
+
+# --- 初期設定 ---
+# トランジット位置は出生データに依存しないため、日ごとの黄経を一度だけ計算して
+# ディスクに保存し、全ワーカープロセスからメモリマップ（読み取り専用）で共有する。
+EPHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ephe')
+TABLE_PATH = os.path.join(EPHE_PATH, 'transits_1900_2150.npy')
+TRANSIT_PLANETS = {"木星": swe.JUPITER, "土星": swe.SATURN, "天王星": swe.URANUS}
+TABLE_START_JD = swe.julday(1900, 1, 1, 0.0)
+TABLE_END_JD = swe.julday(2150, 1, 1, 0.0)
+TABLE_ROWS = int(TABLE_END_JD - TABLE_START_JD) + 1
+
+def build_transit_table(path=TABLE_PATH):
+    swe.set_ephe_path(EPHE_PATH)
+    table = np.empty((TABLE_ROWS, len(TRANSIT_PLANETS)), dtype=np.float64)
+    for row in range(TABLE_ROWS):
+        jday = TABLE_START_JD + row
+        for col, pid in enumerate(TRANSIT_PLANETS.values()):
+            table[row, col] = swe.calc_ut(jday, pid)[0][0]
+    # 他プロセスが書きかけのファイルを読まないよう、一時ファイルに書いてから置き換える
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, table)
+    os.replace(tmp_path, path)
+    return path
+
+@functools.lru_cache(maxsize=None)
+def load_transit_table(path=TABLE_PATH):
+    if os.path.exists(path):
+        table = np.load(path, mmap_mode='r')
+        if table.shape == (TABLE_ROWS, len(TRANSIT_PLANETS)) and table.dtype == np.float64:
+            return table
+    build_transit_table(path)
+    return np.load(path, mmap_mode='r')
+
+def transit_positions(jdays, cubic=False):
+    # jdays: ユリウス日の配列 → (日数, 惑星数) の黄経配列。日単位の表を折り返しを考慮して補間する。
+    # 既定は隣り合う2日の線形補間、cubic=True なら前後4日を通る3次式（留の近くでも天文暦とほぼ一致する）
+    jdays = np.atleast_1d(np.asarray(jdays, dtype=np.float64))
+    table = load_transit_table()
+    idx = jdays - TABLE_START_JD
+    in_range = (idx >= 1) & (idx < TABLE_ROWS - 2) if cubic else (idx >= 0) & (idx < TABLE_ROWS - 1)
+    positions = np.empty((len(jdays), len(TRANSIT_PLANETS)), dtype=np.float64)
+    if in_range.any():
+        lo = np.floor(idx[in_range]).astype(np.int64)
+        frac = (idx[in_range] - lo)[:, None]
+        start, stop = int(lo.min()) - 1, int(lo.max()) + 3
+        window = np.asarray(table[max(start, 0):stop])
+        offset = max(start, 0)
+        p0, p1 = window[lo - offset], window[lo - offset + 1]
+        if not cubic:
+            positions[in_range] = (p0 + frac * ((p1 - p0 + 180) % 360 - 180)) % 360
+        else:
+            # p0 を基準に前後の日の差を折り返しなしで取り、-1, 0, 1, 2 日目を通るラグランジュ補間をする
+            pm, p2 = window[lo - offset - 1], window[lo - offset + 2]
+            dm, d1, d2 = [(p - p0 + 180) % 360 - 180 for p in (pm, p1, p2)]
+            t = frac
+            positions[in_range] = (p0 - t * (t - 1) * (t - 2) / 6 * dm - (t + 1) * t * (t - 2) / 2 * d1 + (t + 1) * t * (t - 1) / 6 * d2) % 360
+    # 表の範囲外（1900年以前・2150年以降）は従来どおり天文暦で計算する
+    for i in np.flatnonzero(~in_range):
+        metrics.count("ephemeris_calls", len(TRANSIT_PLANETS))
+        positions[i] = [swe.calc_ut(jdays[i], pid)[0][0] for pid in TRANSIT_PLANETS.values()]
+    return positions
+
+if __name__ == "__main__":
+    print(f"トランジット表を作成しました: {build_transit_table(sys.argv[1] if len(sys.argv) > 1 else TABLE_PATH)}")